@@ -13,232 +13,354 @@ optional arguments:
 """
 
 import argparse
-import json
 import logging
 
 # System modules
 import os
+import shutil
 import sys
-from hashlib import md5
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import blake2b
 
 # ML modules
+import orjson
 import pandas as pd
 import requests
+import urllib3
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Yelp's GraphQL endpoint
+YELP_GRAPHQL_URL = "https://api.yelp.com/v3/graphql"
+# Yelp's GraphQL search query, formatted with the parameters of each page
+YELP_SEARCH_QUERY = """{{
+    search(
+        categories: "{category}",
+        location: "{location}",
+        offset: {offset},
+        limit: {limit}
+    ) {{
+        business {{
+            alias
+            review_count
+            rating
+            price
+            location {{
+                city
+                state
+                postal_code
+                country
+            }}
+            coordinates {{
+                latitude
+                longitude
+            }}
+            categories {{
+                alias
+                parent_categories {{
+                    alias
+                }}
+            }}
+            photos
+            reviews {{
+                text
+                rating
+            }}
+        }}
+    }}
+}}"""
+# Columns and dtypes of the businesses data (see
+#   https://www.yelp.com/developers/graphql/objects/business)
+# Low-cardinality text columns are stored as "category", the others as "string"
+BUSINESSES_DTYPES = {
+    "business_alias": "string",  # Unique Yelp alias of this business.
+    "business_review_count": "int32",  # Total number of reviews
+    "business_rating": "float32",  # Average of the ratings of all reviews
+    "business_price": "int8",  # Price range, from "$" to "$$$$" (inclusive)
+    "business_city": "category",  # City of this business
+    "business_state": "category",  # ISO 3166-2 (with a few exceptions) state code
+    # (see https://www.yelp.com/developers/documentation/v3/state_codes)
+    "business_postal_code": "string",  # Postal code
+    # (see https://en.wikipedia.org/wiki/Postal_code)
+    "business_country": "category",  # ISO 3166-1 alpha-2 country code
+    "business_latitude": "float32",  # Latitude
+    "business_longitude": "float32",  # Longitude
+    "business_categories": "string",  # List of categories
+    "business_parent_categories": "category",  # List of parent categories
+}
+# Columns and dtypes of the reviews data
+REVIEWS_DTYPES = {
+    "business_alias": "category",  # Unique Yelp alias of the business.
+    "review_text": "string",  # Text excerpt of this review.
+    "review_rating": "float32",  # Rating of this review.
+}
+# Columns and dtypes of the photos data
+PHOTOS_DTYPES = {
+    "business_alias": "category",  # Unique Yelp alias of the business.
+    "photo_url": "string",  # URL of the photo.
+    "file_name": "string",  # Local file name of the photo.
+}
+
+
+def get_yelp_page(
+    pool: urllib3.PoolManager,
+    category: str,
+    location: str,
+    offset: int,
+    limit: int,
+) -> dict:
+    """
+    Get a single page of Yelp search results from API.
+
+    Params:
+        pool: urllib3.PoolManager - HTTP connection pool holding the request
+            headers
+        category: str - Yelp category
+        location: str - Yelp location to search
+        offset: int - Offset of the first result of the page
+        limit: int - Number of results of the page
 
-# Import custom helper libraries
-import src.data.helpers as data_helpers
+    Returns:
+        data: dict - parsed response of the Yelp API
+    """
+    # Build the GraphQL query
+    query = YELP_SEARCH_QUERY.format(
+        category=category,
+        location=location,
+        offset=offset,
+        limit=limit,
+    ).encode("utf-8")
+    # Send the query to the Yelp API, the whole body is read in a single pass
+    response = pool.request("POST", YELP_GRAPHQL_URL, body=query, timeout=30.0)
+    # Check the response status
+    if not response.status == 200:
+        raise Exception(
+            "Yelp API request failed with status code "
+            + str(response.status)
+            + f" . Response text: { response.data.decode('utf-8', 'replace') }"
+        )
+
+    # Parse the response bytes directly, without decoding them to `str` first
+    data = orjson.loads(response.data)
+
+    if "errors" in data:
+        raise Exception(f"Yelp API request failed with errors: { data['errors'] }")
+
+    return data
+
+
+def add_yelp_page(
+    data: dict,
+    businesses: dict[str, list],
+    reviews: dict[str, list],
+    photos: dict[str, list],
+) -> None:
+    """
+    Add the data of a page of Yelp search results to the columns lists.
+
+    Params:
+        data: dict - parsed response of the Yelp API (see `get_yelp_page`)
+        businesses: dict[str, list] - businesses columns to append to
+        reviews: dict[str, list] - reviews columns to append to
+        photos: dict[str, list] - photos columns to append to
+
+    Returns:
+        None
+    """
+    for business in data.get("data", {}).get("search", {}).get("business", []):
+        alias = business.get("alias")
+        price = business.get("price")
+        business_location = business.get("location", {})
+        coordinates = business.get("coordinates", {})
+        categories = business.get("categories") or []
+
+        # Add the business data to the columns
+        businesses["business_alias"].append(alias)
+        businesses["business_review_count"].append(business.get("review_count"))
+        businesses["business_rating"].append(business.get("rating"))
+        businesses["business_price"].append(
+            # count the number of characters
+            len(price)
+            if price is not None
+            else 0
+        )
+        businesses["business_city"].append(business_location.get("city"))
+        businesses["business_state"].append(business_location.get("state"))
+        businesses["business_postal_code"].append(business_location.get("postal_code"))
+        businesses["business_country"].append(business_location.get("country"))
+        businesses["business_latitude"].append(coordinates.get("latitude"))
+        businesses["business_longitude"].append(coordinates.get("longitude"))
+        businesses["business_categories"].append(
+            orjson.dumps(
+                sorted(
+                    # set comprehension to remove duplicates, sorted so that
+                    # equal sets always serialize to the same string (null
+                    # aliases are skipped, as they cannot be sorted with strings)
+                    {cat.get("alias") for cat in categories if cat.get("alias")}
+                )
+            ).decode()
+        )
+        businesses["business_parent_categories"].append(
+            orjson.dumps(
+                sorted(
+                    {  # set comprehension to remove duplicates
+                        parent_cat.get("alias")
+                        for cat in categories
+                        for parent_cat in cat.get("parent_categories") or []
+                        if parent_cat.get("alias")
+                    }
+                )
+            ).decode()
+        )
+
+        for photo in business.get("photos", []) or []:
+            # Add the photo data to the columns
+            photos["business_alias"].append(alias)
+            photos["photo_url"].append(photo)
+            photos["file_name"].append(
+                alias
+                + "_"
+                + blake2b(photo.encode("utf-8"), digest_size=16).hexdigest()
+                + ".jpg"
+            )
+
+        for review in business.get("reviews", []) or []:
+            # Add the review data to the columns
+            reviews["business_alias"].append(alias)
+            reviews["review_text"].append(review.get("text"))
+            reviews["review_rating"].append(review.get("rating"))
 
 
 def get_yelp_data(
     locations: list[str],
     category: str = "restaurants",
+    max_workers: int = 5,
 ) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """
     Get Yelp data from API.
 
-    - iterate over the locations
-        - build a GraphQL query to get the data
-        - send the query to the Yelp API
-        - parse the response
-        - append to the dataframe
-    - return the dataframes
+    - list the pages to request for each location
+    - request the pages concurrently (see `get_yelp_page`)
+    - iterate over the responses
+        - append to the columns lists (see `add_yelp_page`)
+    - build and return the dataframes
 
     Params:
         locations: str[] (default: ["Paris"]) - List of Yelp locations to search
         category: str (default: "restaurants") - Yelp category (see
             https://www.yelp.com/developers/documentation/v3/all_category_list)
+        max_workers: int (default: 5) - Number of concurrent requests to the
+            Yelp API
 
     Returns:
         businesses: pd.DataFrame - businesses data from Yelp API request
         reviews: pd.DataFrame - reviews data from Yelp API request
         photos: pd.DataFrame - photos data from Yelp API request
     """
-    # businesses data (see
-    #   https://www.yelp.com/developers/graphql/objects/business)
-    businesses = pd.DataFrame(
-        columns=[
-            "business_alias",  # Unique Yelp alias of this business.
-            "business_review_count",  # Total number of reviews
-            "business_rating",  # Average of the ratings of all reviews
-            "business_price",  # Price range, from "$" to "$$$$" (inclusive)
-            "business_city",  # City of this business
-            "business_state",  # ISO 3166-2 (with a few exceptions) state code
-            # (see https://www.yelp.com/developers/documentation/v3/state_codes)
-            "business_postal_code",  # Postal code
-            # (see https://en.wikipedia.org/wiki/Postal_code)
-            "business_country",  # ISO 3166-1 alpha-2 country code
-            "business_latitude",  # Latitude
-            "business_longitude",  # Longitude
-            "business_categories",  # List of categories
-            "business_parent_categories",  # List of parent categories
-        ]
-    )
-    reviews = pd.DataFrame(
-        columns=[
-            "business_alias",  # Unique Yelp alias of the business.
-            "review_text",  # Text excerpt of this review.
-            "review_rating",  # Rating of this review.
-        ]
-    )
-    photos = pd.DataFrame(
-        columns=[
-            "business_alias",  # Unique Yelp alias of the business.
-            "photo_url",  # URL of the photo.
-        ]
-    )
+    # Data is accumulated column by column, and the dataframes are built once at
+    # the end : appending to a dataframe copies it entirely on each call.
+    businesses_cols: dict[str, list] = {col: [] for col in BUSINESSES_DTYPES}
+    reviews_cols: dict[str, list] = {col: [] for col in REVIEWS_DTYPES}
+    photos_cols: dict[str, list] = {col: [] for col in PHOTOS_DTYPES}
 
-    # Yelp's GraphQL endpoint
-    url = "https://api.yelp.com/v3/graphql"
-    # Request headers
-    headers = {
-        "Authorization": f"Bearer {YELP_API_KEY}",
-        "Content-Type": "application/graphql",
-    }
     count = 200  # Yelp's GraphQL API returns a maximum of 240 total results
     limit = 50  # Yelp's GraphQL API returns a maximum of 50 results per request
 
-    for location in locations:
-        for offset in range(0, count, limit):
-            # Build the GraphQL query
-            query = f'{{\n\
-        search(\
-            categories: "{ category }", \
-            location: "{ location }", \
-            offset: { offset }, \
-            limit:  { limit }\
-        ) {{\n\
-            business {{\n\
-                alias\n\
-                review_count\n\
-                rating\n\
-                price\n\
-                location {{\n\
-                    city\n\
-                    state\n\
-                    postal_code\n\
-                    country\n\
-                }}\n\
-                coordinates {{\n\
-                    latitude\n\
-                    longitude\n\
-                }}\n\
-                categories {{\n\
-                    alias\n\
-                    parent_categories {{\n\
-                        alias\n\
-                    }}\n\
-                }}\n\
-                photos\n\
-                reviews {{\n\
-                    text\n\
-                    rating\n\
-                }}\n\
-            }}\n\
-        }}\n\
-    }}'
-            # Send the query to the Yelp API
-            response = requests.post(url, headers=headers, data=query)
-            # Parse the response
-            if not response.status_code == 200:
-                raise Exception(
-                    "Yelp API request failed with status code "
-                    + str(response.status_code)
-                    + f" . Response text: { response.text }"
-                )
+    # (location, offset) of each page to request
+    pages = [
+        (location, offset)
+        for location in locations
+        for offset in range(0, count, limit)
+    ]
+
+    # Thread-safe connection pool, with the request headers
+    with urllib3.PoolManager(
+        maxsize=max_workers,
+        headers={
+            "Authorization": f"Bearer {YELP_API_KEY}",
+            "Content-Type": "application/graphql",
+        },
+    ) as pool, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Pages are requested concurrently, and yielded in the order of `pages`
+        for data in executor.map(
+            lambda page: get_yelp_page(pool, category, *page, limit), pages
+        ):
+            # Only the columns are kept, the page is released once processed
+            add_yelp_page(data, businesses_cols, reviews_cols, photos_cols)
+
+    # Build the dataframes, applying the column dtypes in a single pass
+    businesses = pd.DataFrame(businesses_cols).astype(BUSINESSES_DTYPES)
+    reviews = pd.DataFrame(reviews_cols).astype(REVIEWS_DTYPES)
+    photos = pd.DataFrame(photos_cols).astype(PHOTOS_DTYPES)
 
-            # Parse the response
-            data = response.json()
+    # Return the dataframes
+    return businesses, reviews, photos
 
-            if "errors" in data:
-                raise Exception(
-                    f"Yelp API request failed with errors: { data['errors'] }"
-                )
 
-            for business in data.get("data", {}).get("search", {}).get("business", []):
-                # Add the business data to the dataframe
-                businesses = businesses.append(
-                    {
-                        "business_alias": business.get("alias"),
-                        "business_review_count": business.get("review_count"),
-                        "business_rating": business.get("rating"),
-                        "business_price": len(  # count the number of characters
-                            business.get("price")
-                        )
-                        if business.get("price") is not None
-                        else 0,
-                        "business_city": business.get("location", {}).get("city"),
-                        "business_state": business.get("location", {}).get("state"),
-                        "business_postal_code": business.get("location", {}).get(
-                            "postal_code"
-                        ),
-                        "business_country": business.get("location", {}).get("country"),
-                        "business_latitude": business.get("coordinates", {}).get(
-                            "latitude"
-                        ),
-                        "business_longitude": business.get("coordinates", {}).get(
-                            "longitude"
-                        ),
-                        "business_categories": json.dumps(
-                            list(
-                                {  # convert to a set to remove duplicates
-                                    cat.get("alias")
-                                    for cat in business.get("categories", [])
-                                }
-                            )
-                        ),
-                        "business_parent_categories": json.dumps(
-                            list(
-                                {  # convert to a set to remove duplicates
-                                    parent_cat.get("alias")
-                                    for cat in business.get("categories", [])
-                                    for parent_cat in cat.get("parent_categories", [])
-                                }
-                            )
-                        ),
-                    },
-                    ignore_index=True,
-                )
-
-                for photo in business.get("photos", []) or []:
-                    # Add the photo data to the dataframe
-                    photos = photos.append(
-                        {
-                            "business_alias": business.get("alias"),
-                            "photo_url": photo,
-                            "file_name": business.get("alias")
-                            + "_"
-                            + md5(photo.encode("utf-8")).hexdigest()  # nosec: B303
-                            + ".jpg",
-                        },
-                        ignore_index=True,
-                    )
+def download_photo(
+    session: requests.Session,
+    photo_url: str,
+    file_path: str,
+) -> None:
+    """
+    Download a single photo and save it to the file path.
 
-                for review in business.get("reviews", []) or []:
-                    # Add the review data to the dataframe
-                    reviews = reviews.append(
-                        {
-                            "business_alias": business.get("alias"),
-                            "review_text": review.get("text"),
-                            "review_rating": review.get("rating"),
-                        },
-                        ignore_index=True,
-                    )
+    Params:
+        session (requests.Session): HTTP session shared between downloads.
+        photo_url (str): URL of the photo to download.
+        file_path (str): Path of the file where the photo should be saved.
 
-    # Return the dataframes
-    return businesses, reviews, photos
+    Returns:
+        None
+    """
+    # Download the photo
+    with session.get(photo_url, stream=True, timeout=30) as response:
+        if not response.status_code == 200:
+            logging.warning(
+                f"Photo URL : { photo_url }\n"
+                + "Yelp API request failed with status code: "
+                + f"{ response.status_code }.\n"
+                + f"Response text: { response.text }"
+            )
+            return
+
+        # Decode any transfer content-encoding while streaming
+        response.raw.decode_content = True
+        # Stream to a temporary file unique to this download, so an interrupted
+        # download does not leave a truncated photo under its final name
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(file_path), suffix=".part", delete=False
+        ) as f:
+            part_file_path = f.name
+            try:
+                # Stream the photo to the file by chunks of 64 KB
+                shutil.copyfileobj(response.raw, f, length=64 * 1024)
+            except BaseException:
+                f.close()
+                os.remove(part_file_path)
+                raise
+        os.replace(part_file_path, file_path)
 
 
 def download_photos(
     photos: pd.DataFrame,
     target_path: str,
+    max_workers: int = 16,
 ) -> None:
     """
     Download photos from the Yelp API and save them to the target path.
 
+    - list the existing files once, to skip the photos already downloaded
+    - skip the duplicate photos, so each photo is downloaded only once
+    - share a single HTTP session, so connections are reused between photos
+    - download the photos concurrently in a thread pool
+
     Params:
         photos (pd.DataFrame): Dataframe containing the photos to download.
         target_path (str): Path to the directory where the photos should be saved.
+        max_workers (int): Number of concurrent downloads.
 
     Returns:
         None
@@ -248,25 +370,37 @@ def download_photos(
         logging.info("Creating %s", target_path)
         os.makedirs(target_path)
 
-    for photo in photos.itertuples(index=False):
-        file_path = os.path.join(target_path, photo.file_name)
-
-        if not os.path.exists(file_path):
-            # Download the photo
-            request = requests.get(photo.photo_url)
-            if not request.status_code == 200:
-                logging.warning(
-                    f"Photo URL : { photo.photo_url }\n"
-                    + "Yelp API request failed with status code: "
-                    + f"{ request.status_code }.\n"
-                    + f"Response text: { request.text }"
+    # Photos already downloaded
+    existing_files = set(os.listdir(target_path))
+
+    with requests.Session() as session:
+        adapter = HTTPAdapter(
+            pool_connections=max_workers,
+            pool_maxsize=max_workers,
+            max_retries=Retry(total=3, backoff_factor=0.5),
+        )
+        session.mount("https://", adapter)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for photo_url, file_name in zip(
+                photos["photo_url"].to_numpy(), photos["file_name"].to_numpy()
+            ):
+                if file_name in existing_files:
+                    continue
+                # Submit each photo only once, even if it appears in several rows
+                existing_files.add(file_name)
+                futures.append(
+                    executor.submit(
+                        download_photo,
+                        session,
+                        photo_url,
+                        os.path.join(target_path, file_name),
+                    )
                 )
-                continue
-
-            photo_data = request.content
-            with open(file_path, "wb") as f:
-                # Write the photo to the file
-                f.write(photo_data)
+            for future in as_completed(futures):
+                # Raise any exception that occurred in the worker
+                future.result()
 
 
 def main() -> None:
@@ -276,14 +410,14 @@ def main() -> None:
     Returns:
         None
     """
-    businesses_csv_path = os.path.join(DATA_PATH, "businesses.csv")
-    reviews_csv_path = os.path.join(DATA_PATH, "reviews.csv")
-    photos_csv_path = os.path.join(DATA_PATH, "photos.csv")
+    businesses_parquet_path = os.path.join(DATA_PATH, "businesses.parquet")
+    reviews_parquet_path = os.path.join(DATA_PATH, "reviews.parquet")
+    photos_parquet_path = os.path.join(DATA_PATH, "photos.parquet")
 
     if (
-        os.path.exists(businesses_csv_path)
-        and os.path.exists(reviews_csv_path)
-        and os.path.exists(photos_csv_path)
+        os.path.exists(businesses_parquet_path)
+        and os.path.exists(reviews_parquet_path)
+        and os.path.exists(photos_parquet_path)
     ):
         logging.info("Data already downloaded")
         # Early exit if data already downloaded
@@ -306,50 +440,17 @@ def main() -> None:
     )
     logger.info("Data downloaded")
 
-    # Fix dtypes
-    businesses_df["business_alias"] = businesses_df["business_alias"].astype(str)
-    businesses_df["business_review_count"] = businesses_df[
-        "business_review_count"
-    ].astype(int)
-    businesses_df["business_rating"] = businesses_df["business_rating"].astype(float)
-    businesses_df["business_price"] = businesses_df["business_price"].astype(int)
-    businesses_df["business_city"] = businesses_df["business_city"].astype(str)
-    businesses_df["business_state"] = businesses_df["business_state"].astype(str)
-    businesses_df["business_postal_code"] = businesses_df[
-        "business_postal_code"
-    ].astype(str)
-    businesses_df["business_country"] = businesses_df["business_country"].astype(str)
-    businesses_df["business_latitude"] = businesses_df["business_latitude"].astype(
-        float
+    # Save the dataframes
+    logger.info("Saving data")
+    businesses_df.to_parquet(
+        businesses_parquet_path, engine="pyarrow", compression="zstd", index=False
     )
-    businesses_df["business_longitude"] = businesses_df["business_longitude"].astype(
-        float
+    reviews_df.to_parquet(
+        reviews_parquet_path, engine="pyarrow", compression="zstd", index=False
     )
-    businesses_df["business_categories"] = businesses_df["business_categories"].astype(
-        str
+    photos_df.to_parquet(
+        photos_parquet_path, engine="pyarrow", compression="zstd", index=False
     )
-    businesses_df["business_parent_categories"] = businesses_df[
-        "business_parent_categories"
-    ].astype(str)
-
-    reviews_df["business_alias"] = reviews_df["business_alias"].astype(str)
-    reviews_df["review_text"] = reviews_df["review_text"].astype(str)
-    reviews_df["review_rating"] = reviews_df["review_rating"].astype(float)
-
-    photos_df["business_alias"] = photos_df["business_alias"].astype(str)
-    photos_df["photo_url"] = photos_df["photo_url"].astype(str)
-    photos_df["file_name"] = photos_df["file_name"].astype(str)
-
-    # Reduce memory usage
-    businesses_df = data_helpers.reduce_dataframe_memory_usage(businesses_df)
-    reviews_df = data_helpers.reduce_dataframe_memory_usage(reviews_df)
-    photos_df = data_helpers.reduce_dataframe_memory_usage(photos_df)
-
-    # Save the dataframes
-    logger.info("Saving data")
-    businesses_df.to_csv(businesses_csv_path, index=False)
-    reviews_df.to_csv(reviews_csv_path, index=False)
-    photos_df.to_csv(photos_csv_path, index=False)
     logger.info("Data saved")
 
     # Save the photos